@@ -0,0 +1,116 @@
+# Measures how long it takes to describe a short file, which is dominated by
+# starting Python and importing modules rather than by describing anything.
+#
+#   python3 benchmark_startup.py [RUNS]
+#
+# Each command is run RUNS times and the median wall time is reported,
+# along with how it compares to the first version of describe.py in the
+# git history, followed by the slowest imports of each, as reported by
+# -X importtime (which needs Python 3.7 or later).
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+sample = '''import sys
+
+
+def greet(name):
+    return 'Hello, ' + name
+
+
+for arg in sys.argv:
+    # Greet everyone named on the command line
+    print(greet(arg))
+'''
+
+
+def timed(command, env):
+    start = time.perf_counter()
+    subprocess.run(command, cwd=here, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def slowest_imports(command, env, count):
+    result = subprocess.run([command[0], '-X', 'importtime'] + command[1:],
+                            cwd=here, env=env, check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self, cumulative, name = line[12:].split('|')
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def baseline(filename):
+    try:
+        root = subprocess.run(['git', 'rev-list', '--max-parents=0', 'HEAD'],
+                              cwd=here, check=True, stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout.split()[0]
+        source = subprocess.run(['git', 'show', root + ':describe.py'],
+                                cwd=here, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return False
+    with open(filename, 'w') as f:
+        f.write(source)
+    return True
+
+
+def main(runs):
+    # The fast entry point relies on Python caching compiled modules.
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'sample.py')
+    with open(filename, 'w') as f:
+        f.write(sample)
+    outfile = os.path.join(directory, 'sample.md')
+    original = os.path.join(directory, 'original.py')
+    commands = [
+        ('interpreter alone', [sys.executable, '-c', 'pass']),
+        ('original describe.py',
+         [sys.executable, original, outfile, filename]),
+        ('describe.py', [sys.executable, 'describe.py', outfile, filename]),
+        ('python -m describe',
+         [sys.executable, '-m', 'describe', outfile, filename])
+    ]
+    if not baseline(original):
+        print("The original describe.py is not in git, so is not timed.\n")
+        del commands[1]
+    print("Describing a {}-line file, median of {} runs:\n".format(
+        sample.count('\n'), runs))
+    medians = {}
+    for name, command in commands:
+        timed(command, env)
+        times = [timed(command, env) for i in range(runs)]
+        medians[name] = statistics.median(times)
+        line = '{:28} {:8.1f} ms'.format(name, medians[name] * 1e3)
+        if 'original describe.py' in medians:
+            line += '  {:5.2f}x the original'.format(
+                medians[name] / medians['original describe.py'])
+        print(line)
+    if sys.version_info < (3, 7):
+        print("\nSlowest imports are not shown, as -X importtime needs "
+              "Python 3.7 or later.")
+    else:
+        for name, command in commands[1:]:
+            print("\nSlowest imports of {} (cumulative):\n".format(name))
+            for us, module in slowest_imports(command, env, 8):
+                print('{:28} {:8.1f} ms'.format(module, us / 1e3))
+    for path in os.listdir(directory):
+        os.remove(os.path.join(directory, path))
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -1,8 +1,8 @@
-import ast
-import dis
-import re
+import array
+import marshal
+import os
 import sys
-import types
+import time
 
 title = "The Program Which Generates This Book"
 author = "Martin O'Leary"
@@ -28,7 +28,7 @@ the abstract syntax tree and the bytecode representation are somewhat unstable.
 Different versions of the Python interpreter may yield different abstract syntax
 trees and different bytecode representations of the same program. This book was
 generated using `Python {}`.
-""".format(sys.version)
+"""
 
 
 def title_block():
@@ -36,6 +36,12 @@ def title_block():
 
 
 def describe_op(op, codes):
+    index_position(op.offset)
+    indexed('op', op.opname)
+    if op.opname in attribute_ops:
+        indexed('attr', op.argval)
+    elif op.opname in name_ops:
+        indexed('name', op.argval)
     f = descriptors.get(op.opname, None)
     if f:
         s = f(op, codes)
@@ -47,31 +53,532 @@ def describe_op(op, codes):
 
 
 def describe_file(filename):
-    codetxt = open(filename).read()
-    txt = title_block()
-    txt += "# About this book\n\n"
-    txt += preface
-    txt += "\n\n## License\n\n"
-    txt += open("LICENSE.md").read()
-    txt += '\n\n# Source code\n\n'
-    txt += '```\n' + codetxt + '\n```\n\n'
-    txt += '# Abstract syntax tree\n\n'
-    txt += describe_node(ast.parse(codetxt))
-    txt += '\n\n# Bytecode\n\n'
-    codes = [(filename, compile(codetxt, filename, 'exec', optimize=1))]
-    while codes:
-        name, code = codes.pop(0)
-        txt += '## {}'.format(name)
-        for op in dis.get_instructions(code):
+    return describe_book(compile_book(filename))
+
+
+def describe_book(book):
+    tree, codes = read_book(book)
+    xref.clear()
+    xref.update(build_xref(tree, codes, book.source.count('\n') + 1))
+    memo.clear()
+    memo.update(build_memo(book))
+    if index:
+        index.clear()
+        index.update(build_index())
+    txt = written(title_block())
+    txt += written("# About this book\n\n")
+    txt += written(preface.format(book.version))
+    txt += written("\n\n## License\n\n")
+    txt += written(book.license)
+    txt += written('\n\n# Source code\n\n')
+    txt += written(describe_source(book.source))
+    txt += written('# Abstract syntax tree\n\n')
+    index_section('tree')
+    txt += describe_node(tree)
+    txt += written('\n\n# Bytecode\n\n')
+    for code in codes:
+        index_section(code_anchor(code))
+        txt += written('## {} {{#{}}}'.format(code.name, code_anchor(code)))
+        for op in code.instructions:
             desc = describe_op(op, codes)
+            if op.starts_line:
+                desc = xref_bytecode(code.name, op.starts_line) + desc
             if not desc: continue
             if op.starts_line:
-                txt += '\n\n'
-            txt += desc + ' '
-        txt += '\n\n'
+                txt += written('\n\n')
+            txt += written(desc + ' ')
+        txt += written('\n\n')
+    return txt
+
+
+def describe_source(codetxt):
+    lines = codetxt.split('\n')
+    chunks = xref['chunks']
+    txt = ''
+    for i, (start, lineno) in enumerate(chunks):
+        if i + 1 < len(chunks):
+            end = chunks[i + 1][0]
+        else:
+            end = len(lines) + 1
+        sections = xref['sections'].get(start, {})
+        links = xref_links(lineno, source=False, bytecode=False)
+        # Link to where each code object's bytecode for the chunk begins,
+        # which may be on any of its lines
+        first = {}
+        for line in range(start, end):
+            for anchor, code in xref['bytecode'].get(line, {}).items():
+                first.setdefault(code_anchor(code), (code.name, anchor))
+        for key, (name, anchor) in first.items():
+            if key not in sections:
+                links.append(bytecode_link(name, anchor))
+        for anchor, code in sections.items():
+            links.append(bytecode_link(code.name, anchor))
+        if links:
+            txt += '*(See also {}.)*\n\n'.format(as_list(links))
+        txt += '```{#src-' + str(start) + '}\n'
+        txt += '\n'.join(lines[start - 1:end - 1]) + '\n```\n\n'
     return txt
 
 
+def code_name(code):
+    name = code.co_name
+    if name.startswith('<'):
+        name = code.co_name[1:-1] + ':' + str(code.co_firstlineno)
+    return name
+
+
+def code_anchor(code):
+    return 'code-{}-{}'.format(slug(code.name), code.firstlineno)
+
+
+def slug(name):
+    return '-'.join(''.join(c if c.isalnum() or c == '_' else ' '
+                            for c in name).split())
+
+
+# The book is first compiled into a flat array of integer events, which
+# refer to names, strings and numbers by their index in a table of interned
+# constants. Each kind of event has a fixed length:
+#
+#   NODE type lineno shape      followed by the fields of the node
+#   LIST length                 followed by the items of the list
+#   CONST index
+#   CODE name firstlineno count followed by count OP events
+#   OP opname kind arg offset starts_line is_jump_target
+#
+# Nodes with the same shape are structurally identical subtrees.
+NODE, LIST, CONST, CODE, OP = range(5)
+event_sizes = [4, 2, 2, 4, 7]
+ARG_VALUE, ARG_CODE = range(2)
+book_magic = b'BOOKIR\x00\x01'
+
+
+class Book:
+    __slots__ = ('filename', 'version', 'source', 'license', 'types',
+                 'consts', 'shapes', 'events')
+
+
+class Node:
+    __slots__ = ('lineno', 'shape')
+    category = 'AST'
+
+
+class Code:
+    __slots__ = ('name', 'firstlineno', 'instructions')
+
+
+class Instruction:
+    __slots__ = ('opname', 'argval', 'offset', 'starts_line',
+                 'is_jump_target')
+
+
+class CodeRef:
+    __slots__ = ('name', )
+
+
+# The ast and dis modules are only imported once a book is compiled, so that
+# rendering a book which has already been compiled does not pay for them.
+def compile_book(filename):
+    import ast
+    import dis
+    book = Book()
+    book.filename = os.path.abspath(filename)
+    book.version = sys.version
+    book.source = open(filename).read()
+    book.license = open("LICENSE.md").read()
+    book.types = []
+    book.consts = []
+    book.events = array.array('i')
+    tables = {'types': {}, 'consts': {}, 'shapes': {}}
+    compile_node(book, tables, ast.parse(book.source))
+    book.shapes = len(tables['shapes'])
+    codes = [(filename, compile(book.source, filename, 'exec', optimize=1))]
+    while codes:
+        name, code = codes.pop(0)
+        metrics['code_objects_queued'] = len(codes)
+        instructions = list(dis.get_instructions(code))
+        book.events.extend((CODE, intern_value(book, tables, name),
+                            code.co_firstlineno, len(instructions)))
+        for op in instructions:
+            kind, arg = ARG_VALUE, op.argval
+            if isinstance(arg, type(code)):
+                kind, arg = ARG_CODE, code_name(arg)
+                codes.append((arg, op.argval))
+                metrics['code_objects_queued'] = len(codes)
+            book.events.extend((OP, intern_value(book, tables, op.opname),
+                                kind, intern_value(book, tables, arg),
+                                op.offset, op.starts_line or 0,
+                                op.is_jump_target))
+        metrics['code_objects_done'] += 1
+    return book
+
+
+def compile_node(book, tables, node):
+    metrics['ast_nodes_compiled'] += 1
+    name = node.__class__.__name__
+    if name not in tables['types']:
+        tables['types'][name] = len(book.types)
+        book.types.append((name, tuple(node._fields),
+                           node.__class__.__bases__[0].__name__))
+    book.events.extend((NODE, tables['types'][name],
+                        getattr(node, 'lineno', 0), 0))
+    at = len(book.events) - 1
+    key = [tables['types'][name]]
+    for field in node._fields:
+        key.append(compile_value(book, tables, getattr(node, field, None)))
+    shapes = tables['shapes']
+    book.events[at] = shapes.setdefault(tuple(key), len(shapes))
+    return book.events[at]
+
+
+def compile_value(book, tables, value):
+    # Syntax tree nodes are the only field values with _fields
+    if hasattr(value, '_fields'):
+        return compile_node(book, tables, value)
+    elif isinstance(value, list):
+        book.events.extend((LIST, len(value)))
+        return tuple(compile_value(book, tables, item) for item in value)
+    index = intern_value(book, tables, value)
+    book.events.extend((CONST, index))
+    return -1 - index
+
+
+def intern_value(book, tables, value):
+    try:
+        key = marshal.dumps(value)
+    except ValueError:
+        value = repr(value)
+        key = marshal.dumps(value)
+    if key not in tables['consts']:
+        tables['consts'][key] = len(book.consts)
+        book.consts.append(value)
+    return tables['consts'][key]
+
+
+def save_book(book, filename):
+    f = open(filename, 'wb')
+    f.write(book_magic)
+    f.write(marshal.dumps((sys.byteorder, book.events.itemsize,
+                           book.filename, book.version, book.source,
+                           book.license, tuple(book.types),
+                           tuple(book.consts), book.shapes,
+                           book.events.tobytes())))
+    f.close()
+
+
+def load_book(filename):
+    f = open(filename, 'rb')
+    data = f.read()
+    f.close()
+    book = Book()
+    book.events = array.array('i')
+    if not data.startswith(book_magic):
+        raise ValueError("{} is not a compiled book".format(filename))
+    (byteorder, itemsize, book.filename, book.version, book.source,
+     book.license, book.types, book.consts, book.shapes,
+     events) = marshal.loads(data[len(book_magic):])
+    if itemsize != book.events.itemsize:
+        raise ValueError("{} was compiled on an incompatible platform".format(
+            filename))
+    book.events.frombytes(events)
+    if byteorder != sys.byteorder:
+        book.events.byteswap()
+    return book
+
+
+def read_book(book):
+    classes = [record_class(*entry) for entry in book.types]
+    tree, pos = read_value(book, classes, 0)
+    codes = []
+    while pos < len(book.events):
+        code, pos = read_code(book, pos)
+        codes.append(code)
+    return tree, codes
+
+
+def record_class(name, fields, category):
+    return type(name, (Node, ), {
+        '__slots__': fields,
+        '_fields': fields,
+        'category': category
+    })
+
+
+def read_value(book, classes, pos):
+    events = book.events
+    if events[pos] == NODE:
+        node = classes[events[pos + 1]]()
+        node.lineno = events[pos + 2]
+        node.shape = events[pos + 3]
+        pos += event_sizes[NODE]
+        for field in node._fields:
+            value, pos = read_value(book, classes, pos)
+            setattr(node, field, value)
+        return node, pos
+    elif events[pos] == LIST:
+        items = []
+        count = events[pos + 1]
+        pos += event_sizes[LIST]
+        for i in range(count):
+            item, pos = read_value(book, classes, pos)
+            items.append(item)
+        return items, pos
+    return book.consts[events[pos + 1]], pos + event_sizes[CONST]
+
+
+def read_code(book, pos):
+    events = book.events
+    consts = book.consts
+    code = Code()
+    code.name = consts[events[pos + 1]]
+    code.firstlineno = events[pos + 2]
+    code.instructions = []
+    count = events[pos + 3]
+    pos += event_sizes[CODE]
+    for i in range(count):
+        op = Instruction()
+        op.opname = consts[events[pos + 1]]
+        op.argval = consts[events[pos + 3]]
+        if events[pos + 2] == ARG_CODE:
+            op.argval = CodeRef()
+            op.argval.name = consts[events[pos + 3]]
+        op.offset = events[pos + 4]
+        op.starts_line = events[pos + 5]
+        op.is_jump_target = bool(events[pos + 6])
+        code.instructions.append(op)
+        pos += event_sizes[OP]
+    return code, pos
+
+
+def summarize_book(book):
+    import collections
+    nodes = collections.Counter()
+    opnames = collections.Counter()
+    codes = 0
+    pos = 0
+    while pos < len(book.events):
+        kind = book.events[pos]
+        if kind == NODE:
+            nodes[book.types[book.events[pos + 1]][0]] += 1
+        elif kind == CODE:
+            codes += 1
+        elif kind == OP:
+            opnames[book.consts[book.events[pos + 1]]] += 1
+        pos += event_sizes[kind]
+    txt = "Summary of {} (Python {})\n\n".format(
+        book.filename, book.version.split()[0])
+    txt += "Source code: {} lines, {} characters.\n".format(
+        book.source.count('\n') + 1, len(book.source))
+    txt += "Abstract syntax tree: {} nodes, {} distinct subtrees.\n".format(
+        sum(nodes.values()), book.shapes)
+    txt += "Bytecode: {} code objects, {} instructions.\n\n".format(
+        codes, sum(opnames.values()))
+    txt += "Most common nodes: {}.\n".format(as_list(
+        '{} ({})'.format(name, n) for name, n in nodes.most_common(10)))
+    txt += "Most common instructions: {}.\n".format(as_list(
+        '{} ({})'.format(name, n) for name, n in opnames.most_common(10)))
+    return txt
+
+
+latex_headings = ['chapter', 'section', 'subsection', 'subsubsection',
+                  'paragraph', 'subparagraph']
+latex_specials = str.maketrans({
+    '&': r'\&',
+    '%': r'\%',
+    '$': r'\$',
+    '#': r'\#',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '~': r'\textasciitilde{}',
+    '^': r'\textasciicircum{}',
+    '\\': r'\textbackslash{}'
+})
+
+
+def describe_book_latex(book):
+    return markdown_to_latex(describe_book(book))
+
+
+# LaTeX is converted from the Markdown rendering of the book rather than
+# rendered from the book directly, so only the Markdown which the
+# descriptors and the license emit is understood: headings, fenced code
+# blocks, block quotes, paragraphs, inline code, emphasis, escapes, anchors
+# and links to anchors. Anything else is set as plain text.
+def markdown_to_latex(txt):
+    import re
+    lines = txt.split('\n')
+    out = '\\documentclass{memoir}\n\\usepackage{hyperref}\n'
+    out += '\\title{' + latex_inline(lines[0][2:]) + '}\n'
+    out += '\\author{' + latex_inline(lines[1][2:]) + '}\n'
+    out += '\\begin{document}\n\\maketitle\n\n'
+    paragraph = []
+    code = None
+    for line in lines[2:] + ['']:
+        if code is not None:
+            if line == '```':
+                out += latex_environment('verbatim', '\n'.join(code))
+                code = None
+            else:
+                code.append(line)
+            continue
+        fence = re.match(r'```(?:\{#(.*)\})?$', line)
+        heading = re.match(r'(#+) (.*?)(?: \{#(.*)\})?$', line)
+        if line.strip() and not fence and not heading:
+            paragraph.append(line)
+            continue
+        out += latex_paragraph(paragraph)
+        paragraph = []
+        if fence:
+            out += latex_target(fence.group(1))
+            code = []
+        elif heading:
+            out += '\\{}{{{}}}'.format(
+                latex_headings[min(len(heading.group(1)),
+                                   len(latex_headings)) - 1],
+                latex_inline(heading.group(2)))
+            out += latex_target(heading.group(3)) + '\n\n'
+    return out + '\\end{document}\n'
+
+
+def latex_paragraph(lines):
+    if not lines:
+        return ''
+    if lines[0].startswith('>'):
+        quote = '\n'.join(line[1:].strip() or '\n' for line in lines)
+        return latex_environment('quote', latex_inline(quote))
+    return latex_inline('\n'.join(lines)) + '\n\n'
+
+
+def latex_environment(name, body):
+    return '\\begin{' + name + '}\n' + body + '\n\\end{' + name + '}\n\n'
+
+
+def latex_target(anchor):
+    if not anchor:
+        return ''
+    return '\\hypertarget{' + anchor + '}{}'
+
+
+def latex_inline(s):
+    import re
+    out = ''
+    emphasis = False
+    for match in re.finditer(
+            r'`([^`]*)`|\[\]\{#([^}]*)\}|\[([^\]]*)\]\(#([^)]*)\)|'
+            r'\\(.)|(\*)|([^`\[\\*]+|.)', s, re.S):
+        code, anchor, text, target, escaped, star, plain = match.groups()
+        if code is not None:
+            out += '\\texttt{' + code.translate(latex_specials) + '}'
+        elif anchor is not None:
+            out += latex_target(anchor)
+        elif text is not None:
+            out += '\\hyperlink{' + target + '}{' + latex_inline(text) + '}'
+        elif escaped is not None:
+            out += escaped.translate(latex_specials)
+        elif star:
+            if emphasis:
+                out += '}'
+            else:
+                out += '\\emph{'
+            emphasis = not emphasis
+        else:
+            out += plain.translate(latex_specials)
+    return out
+
+
+xref = {}
+
+
+def build_xref(tree, codes, nlines):
+    chunks = [(1, 1)]
+    for node in tree.body:
+        start = min([node.lineno] + [
+            d.lineno for d in getattr(node, 'decorator_list', [])])
+        if start > chunks[-1][0]:
+            chunks.append((start, node.lineno))
+        elif chunks[-1][0] == 1:
+            chunks[-1] = (1, node.lineno)
+    source = [1] * (nlines + 1)
+    i = 0
+    for line in range(1, nlines + 1):
+        while i + 1 < len(chunks) and chunks[i + 1][0] <= line:
+            i += 1
+        source[line] = chunks[i][0]
+    statements = set()
+    nodes = [tree]
+    while nodes:
+        node = nodes.pop()
+        if node.category == 'stmt':
+            statements.add(node.lineno)
+        for field in node._fields:
+            value = getattr(node, field)
+            if isinstance(value, Node):
+                nodes.append(value)
+            elif isinstance(value, list):
+                nodes.extend(item for item in value if isinstance(item, Node))
+    bytecode = {}
+    sections = {}
+    for code in codes:
+        start = source[min(code.firstlineno, nlines)]
+        sections.setdefault(start, {})[code_anchor(code)] = code
+        for op in code.instructions:
+            if op.starts_line:
+                anchor = 'bc-{}-{}'.format(slug(code.name), op.starts_line)
+                bytecode.setdefault(op.starts_line, {})[anchor] = code
+    return {
+        'chunks': chunks,
+        'source': source,
+        'statements': statements,
+        'bytecode': bytecode,
+        'sections': sections,
+        'emitted': set()
+    }
+
+
+def xref_links(line, source=True, tree=True, bytecode=True):
+    links = []
+    if source and line < len(xref['source']):
+        links.append('line {} of the [source code](#src-{})'.format(
+            line, xref['source'][line]))
+    if tree and line in xref['statements']:
+        links.append('the [abstract syntax tree](#ast-{})'.format(line))
+    if bytecode:
+        for anchor, code in xref['bytecode'].get(line, {}).items():
+            links.append(bytecode_link(code.name, anchor))
+    return links
+
+
+def bytecode_link(name, anchor):
+    return 'the bytecode of [`{}`](#{})'.format(name, anchor)
+
+
+def xref_note(anchor, links):
+    if anchor in xref['emitted']:
+        return ''
+    xref['emitted'].add(anchor)
+    return '*(See also {}.)* '.format(as_list(links))
+
+
+def xref_ast(node, s):
+    anchor = 'ast-{}'.format(node.lineno)
+    note = xref_note(anchor, xref_links(node.lineno, tree=False))
+    if not note:
+        return s
+    if s.startswith('#'):
+        heading, sep, s = s.partition('\n\n')
+        return heading + ' {#' + anchor + '}' + sep + note + s
+    return '[]{#' + anchor + '}' + note + s
+
+
+def xref_bytecode(name, line):
+    anchor = 'bc-{}-{}'.format(slug(name), line)
+    note = xref_note(anchor, xref_links(line, bytecode=False))
+    if not note:
+        return ''
+    return '[]{#' + anchor + '}' + note
+
+
 def describe_number(num):
     words = [
         "zero", "one", "two", "three", "four", "five", "six", "seven", "eight",
@@ -79,7 +586,7 @@ def describe_number(num):
     ]
     if 0 <= num <= 10:
         return words[num]
-    elif num >= -10:
+    elif -10 <= num < 0:
         return "minus " + words[-num]
     return str(num)
 
@@ -92,41 +599,407 @@ def as_list(items):
         return ', '.join(items[:-1]) + ", and " + items[-1]
 
 
+string_escapes = str.maketrans({
+    '_': r'\_',
+    '`': r'\`',
+    '*': r'\*',
+    '\\': r'\\',
+    '#': r'\#',
+    '\n': r'\\n'
+})
+
+
 def escape_string(s):
-    s = re.sub(r'([_`\*\\#])', r'\\\1', s)
-    s = re.sub(r'\n', r'\\\\n', s)
-    return s
+    return s.translate(string_escapes)
 
 
 def describe_value(value, codes):
-    if isinstance(value, types.CodeType):
+    if isinstance(value, CodeRef):
         # print(dir(value))
-        name = value.co_name
-        if name.startswith('<'):
-            name = value.co_name[1:-1] + ':' + str(value.co_firstlineno)
-        codes.append((name, value))
-        return "the code object described under {}".format(name)
+        return "the code object described under {}".format(value.name)
     elif isinstance(value, str):
-        return "the literal string *'{}'*".format(escape_string(value))
+        return "the literal string *'{}'*".format(
+            escape_string(indexed('const', value)))
+    elif isinstance(value, bytes):
+        return "the literal bytes *'{}'*".format(
+            escape_string(repr(indexed('const', value))[2:-1]))
     elif isinstance(value, int):
-        return "the integer constant {}".format(describe_number(value))
+        return "the integer constant {}".format(
+            describe_number(indexed('const', value)))
+    elif isinstance(value, float):
+        return "the floating point constant {}".format(
+            indexed('const', value))
     elif value is None:
-        return "the constant None"
+        return "the constant {}".format(indexed('const', value))
+    elif value == ():
+        return "the empty tuple"
     elif isinstance(value, tuple):
         return "the tuple consisting of " + as_list(
             describe_value(x, codes) for x in value)
+    elif isinstance(value, frozenset):
+        return "the frozen set consisting of " + as_list(
+            describe_value(x, codes) for x in sorted(value, key=repr))
     else:
         print("Uninterpretable constant:", value)
     return repr(value)
 
 
 def describe_node(node):
+    metrics['ast_nodes_described'] += 1
+    key = None
+    if memo and node.category not in ('mod', 'stmt', 'excepthandler'):
+        key = node.shape
+    if key is not None:
+        cache = memo['cache']
+        if key in cache:
+            memo['hits'] += 1
+            cache.move_to_end(key)
+            s, terms = cache[key]
+            for term in terms:
+                index_term(term)
+            return s
+        memo['misses'] += 1
+        start_recording()
+    position = index.get('position')
+    counted = metrics['bytes_written'], metrics['words_written']
+    if node.category in ('stmt', 'excepthandler'):
+        index_position(node.lineno)
     f = descriptors.get(node.__class__.__name__, None)
     if f:
-        return f(node)
+        s = f(node)
     else:
         print(node, node._fields)
-        return str(node)
+        s = str(node)
+    if node.category == 'stmt' and xref:
+        s = xref_ast(node, s)
+    if node.category in ('mod', 'stmt'):
+        written_around(s, counted)
+    if index:
+        index['position'] = position
+    if key is not None:
+        cache[key] = (s, stop_recording())
+        if len(cache) > memo_size:
+            cache.popitem(last=False)
+    return s
+
+
+# Descriptions of expressions depend only on their shape, so structurally
+# identical subtrees (ignoring positions) are described only once.
+memo = {}
+memo_size = 4096
+
+
+def build_memo(book):
+    import collections
+    return {
+        'cache': collections.OrderedDict(),
+        'hits': 0,
+        'misses': 0,
+        'subtrees': book.shapes
+    }
+
+
+def describe_memo():
+    lookups = memo['hits'] + memo['misses']
+    if not lookups:
+        return "Description cache: no lookups"
+    return "Description cache: {} hits, {} misses, {:.1%} hit rate, " \
+        "{} distinct subtrees".format(
+        memo['hits'], memo['misses'], memo['hits'] / lookups,
+        memo['subtrees'])
+
+
+# Names, attributes, constants and opcodes are indexed as they are described,
+# by the section of the book and the line (in the syntax tree) or offset (in
+# the bytecode) where they appear, packed together into one 64-bit position.
+# Index files hold one or more books, and queries intersect the positions of
+# the terms in each file. The index stays empty unless one has been asked for.
+index = {}
+index_magic = b'BOOKIDX\x02'
+attribute_ops = {'LOAD_ATTR', 'STORE_ATTR', 'DELETE_ATTR', 'LOAD_METHOD'}
+name_ops = {
+    'LOAD_NAME', 'STORE_NAME', 'DELETE_NAME', 'LOAD_GLOBAL', 'STORE_GLOBAL',
+    'DELETE_GLOBAL', 'LOAD_FAST', 'STORE_FAST', 'DELETE_FAST', 'LOAD_DEREF',
+    'STORE_DEREF', 'LOAD_CLOSURE', 'LOAD_CLASSDEREF', 'IMPORT_NAME',
+    'IMPORT_FROM'
+}
+
+
+def build_index():
+    return {
+        'sections': [],
+        'section': 0,
+        'position': 0,
+        'postings': {},
+        'recording': []
+    }
+
+
+def index_section(name):
+    if index:
+        index['section'] = len(index['sections'])
+        index['sections'].append(name)
+        index_position(0)
+
+
+def index_position(offset):
+    if index:
+        index['position'] = (index['section'] << 32) + offset
+
+
+def indexed(kind, value):
+    if index:
+        index_term('{}:{}'.format(kind, value))
+    return value
+
+
+def index_term(term):
+    postings = index['postings'].get(term)
+    if postings is None:
+        postings = index['postings'][term] = array.array('q')
+    if not postings or postings[-1] != index['position']:
+        postings.append(index['position'])
+    if index['recording']:
+        index['recording'][-1].append(term)
+
+
+# Terms are recorded while a description is being cached, so that they can
+# be indexed again whenever the cached description is reused
+def start_recording():
+    if index:
+        index['recording'].append([])
+
+
+def stop_recording():
+    if not index:
+        return ()
+    terms = index['recording'].pop()
+    if index['recording']:
+        index['recording'][-1].extend(terms)
+    return terms
+
+
+def save_index(filename, book):
+    write_index(filename, [book], index['sections'],
+                [0] * len(index['sections']), index['postings'])
+
+
+def write_index(filename, books, sections, section_books, postings):
+    terms = {}
+    data = bytearray()
+    for term, positions in postings.items():
+        terms[term] = (len(data), len(positions))
+        data += positions.tobytes()
+    header = marshal.dumps((sys.byteorder, tuple(books), tuple(sections),
+                            tuple(section_books), terms))
+    f = open(filename, 'wb')
+    f.write(index_magic + len(header).to_bytes(8, 'little'))
+    f.write(header)
+    f.write(data)
+    f.close()
+
+
+def open_index(filename):
+    f = open(filename, 'rb')
+    if f.read(len(index_magic)) != index_magic:
+        f.close()
+        raise ValueError("{} is not a book index".format(filename))
+    size = int.from_bytes(f.read(8), 'little')
+    byteorder, books, sections, section_books, terms = marshal.loads(
+        f.read(size))
+    return {
+        'file': f,
+        'start': f.tell(),
+        'byteorder': byteorder,
+        'books': books,
+        'sections': sections,
+        'section_books': section_books,
+        'terms': terms
+    }
+
+
+def index_positions(opened, term):
+    positions = array.array('q')
+    if term in opened['terms']:
+        start, count = opened['terms'][term]
+        opened['file'].seek(opened['start'] + start)
+        positions.fromfile(opened['file'], count)
+        if opened['byteorder'] != sys.byteorder:
+            positions.byteswap()
+    return positions
+
+
+def merge_indexes(output, filenames):
+    books = []
+    sections = []
+    section_books = []
+    postings = {}
+    for filename in filenames:
+        opened = open_index(filename)
+        shift = len(sections) << 32
+        for term in opened['terms']:
+            merged = postings.setdefault(term, array.array('q'))
+            merged.extend(position + shift
+                          for position in index_positions(opened, term))
+        opened['file'].close()
+        section_books.extend(book + len(books)
+                             for book in opened['section_books'])
+        books.extend(opened['books'])
+        sections.extend(opened['sections'])
+    write_index(output, books, sections, section_books, postings)
+
+
+def query_index(terms, filenames):
+    results = []
+    for filename in filenames:
+        opened = open_index(filename)
+        counts = []
+        for term in terms:
+            counts.append((opened['terms'].get(term, (0, 0))[1], term))
+        counts.sort()
+        matches = set(index_positions(opened, counts[0][1]))
+        for count, term in counts[1:]:
+            matches = matches.intersection(index_positions(opened, term))
+        opened['file'].close()
+        for position in sorted(matches):
+            section = position >> 32
+            results.append((opened['books'][opened['section_books'][section]],
+                            opened['sections'][section],
+                            position & 0xffffffff))
+    return results
+
+
+# Progress of the current run, sampled periodically for log lines and for
+# scraping in the Prometheus text format.
+metric_types = [
+    ('code_objects_done', 'counter', "Code objects compiled into the book."),
+    ('code_objects_queued', 'gauge', "Code objects waiting to be compiled."),
+    ('ast_nodes_compiled', 'counter', "Syntax tree nodes compiled."),
+    ('ast_nodes_described', 'counter', "Syntax tree nodes described."),
+    ('bytes_written', 'counter', "Bytes of the book generated."),
+    ('words_written', 'counter', "Words of the book generated."),
+    ('words_per_second', 'gauge', "Words generated per second recently."),
+    ('elapsed_seconds', 'gauge', "Seconds since the run started.")
+]
+metrics = dict.fromkeys([name for name, kind, text in metric_types], 0)
+metrics_start = time.monotonic()
+metrics_sampled = [0, metrics_start]
+metrics_servers = []
+metrics_stops = []
+
+
+def written(s):
+    metrics['bytes_written'] += len(s.encode('utf-8'))
+    metrics['words_written'] += len(s.split())
+    return s
+
+
+# Statements are counted as soon as they are described, so that progress is
+# seen inside long bodies. Nested statements have already been counted by
+# then, so only the rest of the statement is added.
+def written_around(s, counted):
+    bytes_before, words_before = counted
+    metrics['bytes_written'] = bytes_before + len(s.encode('utf-8'))
+    metrics['words_written'] = words_before + len(s.split())
+
+
+def start_metrics(interval, address):
+    if address:
+        metrics_servers.append(serve_metrics(address))
+    if interval or address:
+        import threading
+        done = threading.Event()
+        thread = threading.Thread(
+            target=sample_metrics,
+            args=(interval or 1.0, bool(interval), done),
+            daemon=True)
+        thread.start()
+        metrics_stops.append((done, thread))
+
+
+def stop_metrics(interval):
+    for done, thread in metrics_stops:
+        done.set()
+        thread.join()
+    sample_rates()
+    if interval:
+        print(describe_metrics(), file=sys.stderr, flush=True)
+    for server in metrics_servers:
+        server.shutdown()
+        server.server_close()
+        if isinstance(server.server_address, str):
+            os.remove(server.server_address)
+
+
+def sample_metrics(interval, log, done):
+    while not done.wait(interval):
+        sample_rates()
+        if log:
+            print(describe_metrics(), file=sys.stderr, flush=True)
+
+
+def sample_rates():
+    now = time.monotonic()
+    last_words, last_time = metrics_sampled
+    words = metrics['words_written']
+    if now > last_time:
+        metrics['words_per_second'] = (words - last_words) / (now - last_time)
+    metrics['elapsed_seconds'] = now - metrics_start
+    metrics_sampled[:] = [words, now]
+
+
+def describe_metrics():
+    return 'progress ' + ' '.join(
+        '{}={}'.format(name, round(metrics[name], 1))
+        for name, kind, text in metric_types)
+
+
+def prometheus_metrics():
+    txt = ''
+    for name, kind, text in metric_types:
+        exposed = 'describe_' + name
+        if kind == 'counter':
+            exposed += '_total'
+        txt += '# HELP {} {}\n'.format(exposed, text)
+        txt += '# TYPE {} {}\n'.format(exposed, kind)
+        txt += '{} {}\n'.format(exposed, metrics[name])
+    return txt
+
+
+# The HTTP server pulls in a large part of the standard library, so it is
+# only imported when metrics are served.
+def serve_metrics(address):
+    import http.server
+    import socketserver
+    import stat
+    import threading
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_metrics().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    if address.startswith('unix:'):
+        # A socket left behind by a run which was killed would stop the
+        # address from being bound again
+        if os.path.exists(address[5:]) and \
+                stat.S_ISSOCK(os.stat(address[5:]).st_mode):
+            os.remove(address[5:])
+        server = socketserver.UnixStreamServer(address[5:], MetricsHandler)
+    else:
+        host, sep, port = address.rpartition(':')
+        server = http.server.HTTPServer((host or 'localhost', int(port)),
+                                        MetricsHandler)
+    threading.Thread(target=server.serve_forever, args=(0.05, ),
+                     daemon=True).start()
+    return server
 
 
 descriptors = {}
@@ -146,7 +1019,7 @@ def Module(node):
 @descriptor
 def Import(node):
     return "An import statement for a module named `{}`.".format(
-        node.names[0].name)
+        indexed('name', node.names[0].name))
 
 
 @descriptor
@@ -169,11 +1042,31 @@ def Add(node):
     return "the addition (or concatenation) operator"
 
 
+@descriptor
+def Sub(node):
+    return "the subtraction operator"
+
+
 @descriptor
 def Mult(node):
     return "the multiplication operator"
 
 
+@descriptor
+def Div(node):
+    return "the division operator"
+
+
+@descriptor
+def LShift(node):
+    return "the left shift operator"
+
+
+@descriptor
+def RShift(node):
+    return "the right shift operator"
+
+
 @descriptor
 def BitAnd(node):
     return "the bitwise 'AND' operator"
@@ -192,11 +1085,18 @@ def Index(node):
 
 @descriptor
 def Slice(node):
-    if node.lower:
-        return "a slice from {} to {}".format(
+    if node.lower and node.upper:
+        s = "a slice from {} to {}".format(
             describe_node(node.lower), describe_node(node.upper))
+    elif node.lower:
+        s = "a slice from {} onwards".format(describe_node(node.lower))
+    elif node.upper:
+        s = "a slice up to {}".format(describe_node(node.upper))
     else:
-        return "a slice up to {}".format(describe_node(node.upper))
+        s = "a slice of everything"
+    if node.step:
+        s += ", in steps of {}".format(describe_node(node.step))
+    return s
 
 
 @descriptor
@@ -221,6 +1121,11 @@ def While(node):
     return s
 
 
+@descriptor
+def Pass(node):
+    return "A 'pass' statement, which does nothing."
+
+
 @descriptor
 def Continue(node):
     return "A 'continue' statement."
@@ -228,12 +1133,12 @@ def Continue(node):
 
 @descriptor
 def Name(node):
-    return "the name `{}`".format(node.id)
+    return "the name `{}`".format(indexed('name', node.id))
 
 
 @descriptor
 def NameConstant(node):
-    return "the constant `{}`".format(node.value)
+    return "the constant `{}`".format(indexed('const', node.value))
 
 
 @descriptor
@@ -254,16 +1159,26 @@ def Tuple(node):
             describe_node(elt) for elt in node.elts)
 
 
+@descriptor
+def Set(node):
+    return "a set containing " + as_list(
+        describe_node(elt) for elt in node.elts)
+
+
 @descriptor
 def Dict(node):
-    return "an empty dictionary"
+    if not node.keys:
+        return "an empty dictionary"
+    return "a dictionary mapping " + as_list(
+        "{} to {}".format(describe_node(k), describe_node(v))
+        for k, v in zip(node.keys, node.values))
 
 
 @descriptor
 def FunctionDef(node):
     s = "## {node.name}\n\n" \
-        "A definition of a function named `{node.name}`".format(
-        node=node)
+        "A definition of a function named `{name}`".format(
+        node=node, name=indexed('name', node.name))
     args = node.args
     if len(args.args) == 1:
         s += ", with argument `{}`.".format(args.args[0].arg)
@@ -281,6 +1196,22 @@ def FunctionDef(node):
     return s
 
 
+@descriptor
+def ClassDef(node):
+    s = "## {node.name}\n\n" \
+        "A definition of a class named `{name}`".format(
+        node=node, name=indexed('name', node.name))
+    if node.bases:
+        s += ", deriving from {}".format(as_list(
+            describe_node(base) for base in node.bases))
+    s += ". The body of the class is as follows:\n\n"
+    for nod in node.body:
+        s += describe_node(nod) + '\n\n'
+
+    s += "The class {} ends here.\n\n".format(node.name)
+    return s
+
+
 @descriptor
 def Call(node):
     s = 'a function call, calling the value of {f}'.format(
@@ -303,21 +1234,83 @@ def Call(node):
     return s
 
 
+@descriptor
+def Starred(node):
+    return "the unpacked contents of {}".format(describe_node(node.value))
+
+
+@descriptor
+def Raise(node):
+    if node.exc is None:
+        return "A raise statement, re-raising the exception being handled."
+    if node.cause is None:
+        return "A raise statement, raising {}.".format(
+            describe_node(node.exc))
+    return "A raise statement, raising {}, caused by {}.".format(
+        describe_node(node.exc), describe_node(node.cause))
+
+
+@descriptor
+def Try(node):
+    s = "A `try` statement. The body of the statement is as follows:\n\n"
+    for nod in node.body:
+        s += describe_node(nod) + "\n\n"
+    for handler in node.handlers:
+        s += describe_node(handler) + "\n\n"
+    if node.orelse:
+        s += "If no exception is raised, " \
+            "the following code is then executed:\n\n"
+        for nod in node.orelse:
+            s += describe_node(nod) + "\n\n"
+    if node.finalbody:
+        s += "Whether or not an exception is raised, " \
+            "the following code is then executed:\n\n"
+        for nod in node.finalbody:
+            s += describe_node(nod) + "\n\n"
+    s += "The `try` statement ends here."
+    return s
+
+
+@descriptor
+def ExceptHandler(node):
+    if node.type is None:
+        s = "If any exception is raised"
+    else:
+        s = "If {} is raised".format(describe_node(node.type))
+    if node.name:
+        s += ", with the exception bound to the name `{}`".format(
+            indexed('name', node.name))
+    s += ", the following code is executed instead:\n\n"
+    for nod in node.body:
+        s += describe_node(nod) + "\n\n"
+    s += "The exception handler ends here."
+    return s
+
+
 @descriptor
 def Return(node):
+    if node.value is None:
+        return "A return statement, returning nothing."
     return "A return statement, returning the value of {}.".format(
         describe_node(node.value))
 
 
 @descriptor
 def Str(node):
-    return "the literal string *'{}'*".format(escape_string(node.s))
+    return "the literal string *'{}'*".format(
+        escape_string(indexed('const', node.s)))
+
+
+@descriptor
+def Bytes(node):
+    return "the literal bytes *'{}'*".format(
+        escape_string(repr(indexed('const', node.s))[2:-1]))
 
 
 @descriptor
 def Attribute(node):
     return "an attribute lookup of `{}` on {}".format(
-        node.attr, describe_node(node.value))
+        indexed('attr', node.attr), describe_node(node.value))
 
 
 @descriptor
@@ -349,7 +1342,8 @@ def If(node):
 
 @descriptor
 def Num(node):
-    return "a numeric constant with value {}".format(node.n)
+    return "a numeric constant with value {}".format(
+        indexed('const', node.n))
 
 
 @descriptor
@@ -373,6 +1367,11 @@ def Eq(node):
     return "the equality operator"
 
 
+@descriptor
+def NotEq(node):
+    return "the inequality operator"
+
+
 @descriptor
 def GtE(node):
     return "the 'greater than or equal to' operator"
@@ -381,6 +1380,11 @@ def GtE(node):
 def LtE(node):
     return "the 'less than or equal to' operator"
 
+@descriptor
+def Lt(node):
+    return "the 'less than' operator"
+
+
 @descriptor
 def Gt(node):
     return "the 'greater than' operator"
@@ -391,6 +1395,45 @@ def Is(node):
     return "the identity operator"
 
 
+@descriptor
+def IsNot(node):
+    return "the negated identity operator"
+
+
+@descriptor
+def In(node):
+    return "the membership operator"
+
+
+@descriptor
+def NotIn(node):
+    return "the negated membership operator"
+
+
+@descriptor
+def BoolOp(node):
+    return "{} of {}".format(
+        describe_node(node.op),
+        as_list(describe_node(value) for value in node.values))
+
+
+@descriptor
+def IfExp(node):
+    return "{} if {} is true, or otherwise {}".format(
+        describe_node(node.body), describe_node(node.test),
+        describe_node(node.orelse))
+
+
+@descriptor
+def And(node):
+    return "the logical 'and'"
+
+
+@descriptor
+def Or(node):
+    return "the logical 'or'"
+
+
 @descriptor
 def UnaryOp(node):
     return "{} applied to {}".format(
@@ -565,6 +1608,14 @@ def BUILD_MAP(op, codes):
         describe_number(2 * op.argval))
 
 
+@descriptor
+def BUILD_CONST_KEY_MAP(op, codes):
+    return "The computer takes the top value from the stack as a tuple " \
+        "of keys, and the next {} values as the corresponding values " \
+        "of a new dictionary, which is placed on top of the stack.".format(
+        describe_number(op.argval))
+
+
 @descriptor
 def EXTENDED_ARG(op, codes):
     return ""
@@ -576,12 +1627,40 @@ def BINARY_ADD(op, codes):
         "adds them together, and places the result on top of the stack."
 
 
+@descriptor
+def BINARY_SUBTRACT(op, codes):
+    return "The computer takes the top two values from the stack, " \
+        "subtracts the first from the second, " \
+        "and places the result on top of the stack."
+
+
 @descriptor
 def BINARY_MULTIPLY(op, codes):
     return "The computer takes the top two values from the stack, " \
         "multiplies them together, and places the result on top of the stack."
 
 
+@descriptor
+def BINARY_TRUE_DIVIDE(op, codes):
+    return "The computer takes the top two values from the stack, " \
+        "divides the second by the first, " \
+        "and places the result on top of the stack."
+
+
+@descriptor
+def BINARY_LSHIFT(op, codes):
+    return "The computer takes the top two values from the stack, " \
+        "shifts the second to the left by the first, " \
+        "and places the result on top of the stack."
+
+
+@descriptor
+def BINARY_RSHIFT(op, codes):
+    return "The computer takes the top two values from the stack, " \
+        "shifts the second to the right by the first, " \
+        "and places the result on top of the stack."
+
+
 @descriptor
 def BINARY_AND(op, codes):
     return "The computer takes the top two values from the stack, " \
@@ -602,10 +1681,18 @@ def BUILD_LIST(op, codes):
             describe_number(op.argval))
 
 
+@descriptor
+def BUILD_SET(op, codes):
+    return "The computer takes the top {} values from the stack, " \
+        "puts them in a set, and places it on top of the stack.".format(
+        describe_number(op.argval))
+
+
 @descriptor
 def BUILD_SLICE(op, codes):
-    return "The computer takes the top two values from the stack, " \
-        "creates a slice object from them, and places it on top of the stack."
+    return "The computer takes the top {} values from the stack, " \
+        "creates a slice object from them, and places it on top of the stack." \
+        .format(describe_number(op.argval))
 
 
 @descriptor
@@ -727,6 +1814,52 @@ def UNPACK_SEQUENCE(op, codes):
         describe_number(op.argval))
 
 
+@descriptor
+def CALL_FUNCTION_EX(op, codes):
+    txt = "The computer takes the top value from the stack and uses it " \
+        "as a sequence of positional arguments."
+    if op.argval & 1:
+        txt = "The computer takes the top value from the stack and uses it " \
+            "as a dictionary of keyword arguments, then takes the next " \
+            "value as a sequence of positional arguments."
+    return txt + " It then takes the next value from the stack and " \
+        "calls it as a function with these arguments, " \
+        "placing the return value on top of the stack."
+
+
+@descriptor
+def LOAD_BUILD_CLASS(op, codes):
+    return "The computer places the builtin function which builds classes " \
+        "on top of the stack."
+
+
+@descriptor
+def RAISE_VARARGS(op, codes):
+    if op.argval == 0:
+        return "The computer re-raises the exception currently being handled."
+    return "The computer takes the top value from the stack " \
+        "and raises it as an exception."
+
+
+@descriptor
+def SETUP_EXCEPT(op, codes):
+    return "The computer places a new block for an exception handler on " \
+        "top of the block stack, with the handler at offset {}.".format(
+        op.argval)
+
+
+@descriptor
+def POP_EXCEPT(op, codes):
+    return "The computer removes the block for an exception handler " \
+        "from the block stack, restoring the previous exception state."
+
+
+@descriptor
+def END_FINALLY(op, codes):
+    return "The computer finishes handling an exception, re-raising it " \
+        "if it was not handled."
+
+
 @descriptor
 def YIELD_VALUE(op, codes):
     return "The computer takes the top value from the stack " \
@@ -778,11 +1911,95 @@ def JUMP_IF_FALSE_OR_POP(op, codes):
         "to offset {}. Otherwise it removes the top value from the stack."
 
 
-if __name__ == '__main__':
-    outfile = sys.argv[1]
+@descriptor
+def JUMP_IF_TRUE_OR_POP(op, codes):
+    return "The computer looks at the top value on the stack. " \
+        "If it is true-like (e.g. True, non-empty or non-zero), it jumps " \
+        "to offset {}. Otherwise it removes the top value from the stack." \
+        .format(op.argval)
+
+
+renderers = {
+    'md': describe_book,
+    'tex': describe_book_latex,
+    'txt': summarize_book
+}
+
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description=title)
+    parser.add_argument(
+        'paths', nargs='+', metavar='PATH',
+        help="the output file and the file to describe (this program by "
+        "default), or the index files to search with --query")
+    parser.add_argument(
+        '--progress', type=float, default=0, metavar='SECONDS',
+        help="log progress to stderr every SECONDS seconds")
+    parser.add_argument(
+        '--metrics', metavar='ADDRESS',
+        help="serve Prometheus metrics on HOST:PORT or unix:PATH")
+    parser.add_argument(
+        '--index', metavar='PATH',
+        help="write an index of names, attributes, constants and opcodes")
+    parser.add_argument(
+        '--query', action='append', metavar='KIND:VALUE',
+        help="print where all the given terms appear in the index files, "
+        "e.g. --query op:LOAD_GLOBAL --query name:describe_node")
+    parser.add_argument(
+        '--merge', action='store_true',
+        help="merge the index files given after the first PATH into it")
+    args = parser.parse_args(argv)
+    if args.index and args.paths[0].rpartition('.')[2] in ('ir', 'txt'):
+        parser.error("--index needs a Markdown or LaTeX output file")
+    return parser, args
+
+
+def main(argv):
+    if 1 <= len(argv) <= 2 and not any(arg.startswith('-') for arg in argv):
+        # Without options there is nothing to parse, and importing argparse
+        # takes longer than describing a short file.
+        paths, progress, address, index_file = argv, 0, None, None
+    else:
+        parser, args = parse_args(argv)
+        try:
+            if args.query:
+                for result in query_index(args.query, args.paths):
+                    print('\t'.join(str(field) for field in result))
+                return
+            if args.merge:
+                merge_indexes(args.paths[0], args.paths[1:])
+                return
+        except (OSError, ValueError, EOFError) as e:
+            parser.error(str(e))
+        paths, progress = args.paths, args.progress
+        address, index_file = args.metrics, args.index
+    outfile = paths[0]
     filename = __file__
-    if len(sys.argv) > 2:
-        filename = sys.argv[2]
-    f = open(outfile, "w")
-    f.write(describe_file(filename))
-    f.close()
+    if len(paths) > 1:
+        filename = paths[1]
+    if index_file:
+        index.update(build_index())
+    start_metrics(progress, address)
+    try:
+        if filename.endswith('.ir'):
+            book = load_book(filename)
+        else:
+            book = compile_book(filename)
+        if outfile.endswith('.ir'):
+            save_book(book, outfile)
+        else:
+            f = open(outfile, "w")
+            f.write(renderers.get(outfile.rpartition('.')[2],
+                                  describe_book)(book))
+            f.close()
+        if index_file:
+            save_index(index_file, book.filename)
+    finally:
+        stop_metrics(progress)
+    if memo:
+        print(describe_memo(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])